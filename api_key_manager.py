@@ -1,21 +1,45 @@
 import streamlit as st
+import functools
 import os
 from typing import Optional
 
 
+@functools.lru_cache(maxsize=1)
+def _secrets_api_key() -> Optional[str]:
+    """Read Stability API key from st.secrets once per process"""
+    if 'STABILITY_API_KEY' in st.secrets:
+        return st.secrets['STABILITY_API_KEY']
+    return None
+
+
 class APIKeyManager:
     @staticmethod
     def get_api_key() -> Optional[str]:
-        """Get Stability API key from various sources"""
-        if 'STABILITY_API_KEY' in st.secrets:
-            return st.secrets['STABILITY_API_KEY']
-        if 'stability_api_key' in st.session_state:
-            return st.session_state.stability_api_key
-        return os.getenv('STABILITY_API_KEY')
+        """Get Stability API key from various sources, cheapest first
+        
+        The first key found is remembered in the session so later reruns
+        only need a single session_state lookup.
+        """
+        resolved_key = st.session_state.get('_resolved_api_key')
+        if resolved_key:
+            return resolved_key
+        
+        api_key = (
+            st.session_state.get('stability_api_key')
+            or os.getenv('STABILITY_API_KEY')
+            or _secrets_api_key()
+        )
+        if api_key:
+            st.session_state['_resolved_api_key'] = api_key
+        return api_key
     
     @staticmethod
-    def setup_api_key_ui():
-        """Display API key input in sidebar and stop until key is provided"""
+    def setup_api_key_ui(stop_if_missing: bool = True) -> bool:
+        """Display API key input in sidebar and stop until key is provided
+        
+        With stop_if_missing=False, returns False instead of stopping the
+        script when no key is available.
+        """
         api_key = APIKeyManager.get_api_key()
         
         if api_key:
@@ -36,4 +60,6 @@ class APIKeyManager:
             return True
         
         st.sidebar.warning("Please enter your Stability AI API key")
-        st.stop()  # Stop execution until key is provided
\ No newline at end of file
+        if stop_if_missing:
+            st.stop()  # Stop execution until key is provided
+        return False
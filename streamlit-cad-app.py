@@ -4,15 +4,16 @@ import streamlit as st
 import numpy as np
 from PIL import Image
 import plotly.graph_objects as go
-import tempfile
-import os
 import requests
-from typing import Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional, Tuple
 import logging
 from openai import OpenAI
 import base64
 from io import BytesIO
 import trimesh
+from trimesh.exchange.stl import export_stl
 import streamlit.components.v1 as components
 from pathlib import Path
 
@@ -20,49 +21,102 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Stable Fast 3D works at this resolution; larger inputs only cost upload time
+MAX_INPUT_EDGE = 1024
+
 class StabilityAI3DGenerator:
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.api_url = "https://api.stability.ai/v2beta/3d/stable-fast-3d"
+        # (connect, read) seconds; generation can take up to a couple of minutes
+        self.timeout = (10, 120)
+        
+        # Reuse one pooled HTTPS connection across generations
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=8,
+                # Generation is billed and not idempotent, so only retry when the
+                # server cannot have done the work: connect errors and 429/503
+                max_retries=Retry(
+                    total=3,
+                    connect=3,
+                    read=0,
+                    other=0,
+                    backoff_factor=0.5,
+                    status_forcelist=[429, 503],
+                    allowed_methods=None,
+                    raise_on_status=False
+                )
+            )
+        )
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
     
-    def generate_3d_model(self, image: Image.Image, params: dict) -> bytes:
-        """Generate 3D model from image using Stability AI API"""
+    def generate_3d_model(self, image: Image.Image, params: dict, image_bytes: Optional[bytes] = None) -> bytes:
+        """Generate 3D model from image using Stability AI API
+        
+        If image_bytes already holds a PNG or JPEG encoding of the image it
+        is sent as-is instead of re-encoding the image.
+        """
         try:            
-            # Convert PIL Image to bytes
-            img_byte_arr = BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+            if image_bytes is not None:
+                img_byte_arr = image_bytes
+            else:
+                # Convert PIL Image to bytes
+                img_byte_arr = BytesIO()
+                image.save(img_byte_arr, format='PNG')
+                img_byte_arr = img_byte_arr.getvalue()
             
-            # Make API request
-            response = requests.post(
+            # Make API request; the context manager releases the pooled
+            # connection even if reading the streamed body fails
+            with self.session.post(
                 self.api_url,
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                },
                 files={
                     "image": img_byte_arr
                 },
-                data=params
-            )
-            
-            # Log response status
-            logger.info(f"Stability AI API Response Status: {response.status_code}")
-            
-            if response.status_code == 200:
-                return response.content
-            else:
-                error_msg = response.json().get('message', str(response.json()))
-                logger.error(f"API Error: {error_msg}")
-                raise Exception(f"API Error: {error_msg}")
+                data=params,
+                stream=True,
+                timeout=self.timeout
+            ) as response:
+                # Log response status
+                logger.info("Stability AI API Response Status: %s", response.status_code)
+                
+                if response.status_code != 200:
+                    try:
+                        error_body = response.json()
+                        error_msg = (isinstance(error_body, dict) and error_body.get('message')) or str(error_body)
+                    except ValueError:
+                        # Non-JSON error pages (e.g. from a proxy)
+                        error_msg = response.text[:500]
+                    logger.error("API Error: %s", error_msg)
+                    raise RuntimeError(f"Stability API {response.status_code}: {error_msg}")
+                
+                # Assemble the GLB from the streamed body
+                model_buffer = BytesIO()
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    model_buffer.write(chunk)
+                return model_buffer.getvalue()
                 
         except Exception as e:
-            logger.error(f"Error in 3D generation: {str(e)}")
+            logger.error("Error in 3D generation: %s", e)
             raise
 
+@st.cache_resource(max_entries=8, ttl=3600)
+def get_generator(api_key: str) -> StabilityAI3DGenerator:
+    """Get a generator shared across reruns and sessions for this API key"""
+    logger.info("Creating new StabilityAI3DGenerator instance")
+    return StabilityAI3DGenerator(api_key)
+
+@st.cache_data(show_spinner=False, max_entries=4)
 def create_model_viewer_html(model_data: bytes) -> str:
-    """Create HTML for the 3D model viewer using base64 encoded data"""
+    """Create HTML for the 3D model viewer using base64 encoded data
+    
+    The GLB is decoded into a Blob in the browser and handed to the viewer
+    as an object URL rather than as a multi-megabyte data URL attribute.
+    """
     base64_model = base64.b64encode(model_data).decode('utf-8')
-    blob_url = f"data:model/gltf-binary;base64,{base64_model}"
     
     return f"""
         <script type="module" src="https://unpkg.com/@google/model-viewer@3.4.0/dist/model-viewer.min.js"></script>
@@ -83,7 +137,7 @@ def create_model_viewer_html(model_data: bytes) -> str:
         </style>
         <div class="container">
             <model-viewer
-                src="{blob_url}"
+                id="model-viewer"
                 auto-rotate
                 camera-controls
                 shadow-intensity="1"
@@ -97,30 +151,43 @@ def create_model_viewer_html(model_data: bytes) -> str:
                 style="width: 100%; height: 400px;"
             ></model-viewer>
         </div>
+        <script type="application/octet-stream" id="model-data">{base64_model}</script>
+        <script>
+            const modelData = document.getElementById("model-data").textContent;
+            fetch(`data:model/gltf-binary;base64,${{modelData}}`)
+                .then((response) => response.blob())
+                .then((blob) => {{
+                    document.getElementById("model-viewer").src = URL.createObjectURL(blob);
+                }})
+                .catch((error) => {{
+                    console.error("Failed to load 3D model", error);
+                    document.querySelector(".container").textContent = `Failed to load 3D model: ${{error}}`;
+                }});
+        </script>
     """
 
+@st.cache_data(show_spinner=False, max_entries=8)
 def convert_glb_to_stl(glb_data: bytes) -> bytes:
     """Convert GLB data to STL format"""
     try:
-        # Create a temporary file for the GLB data
-        with tempfile.NamedTemporaryFile(suffix='.glb', delete=False) as tmp_glb:
-            tmp_glb.write(glb_data)
-            tmp_glb.flush()
-            
-            # Load the GLB file with trimesh
-            mesh = trimesh.load(tmp_glb.name)
-            
-            # Export as STL to a bytes buffer
-            stl_buffer = BytesIO()
-            mesh.export(stl_buffer, file_type='stl')
-            
-            # Clean up temporary file
-            os.unlink(tmp_glb.name)
-            
-            return stl_buffer.getvalue()
-            
+        # Load the GLB data with trimesh straight from memory
+        # Skip trimesh's default processing; the fixes we need are applied below
+        mesh = trimesh.load(BytesIO(glb_data), file_type='glb', process=False)
+        
+        # Flatten multi-node GLBs into a single mesh in one concatenation pass
+        if isinstance(mesh, trimesh.Scene):
+            mesh = trimesh.util.concatenate(mesh.dump())
+        
+        # Collapse coincident vertices and drop degenerate/duplicate faces
+        mesh.merge_vertices(merge_tex=False, merge_norm=True)
+        mesh.update_faces(mesh.nondegenerate_faces())
+        mesh.update_faces(mesh.unique_faces())
+        
+        # Export as binary STL
+        return export_stl(mesh)
+        
     except Exception as e:
-        logger.error(f"Error converting GLB to STL: {str(e)}")
+        logger.error("Error converting GLB to STL: %s", e)
         raise
 
 def main():
@@ -130,7 +197,7 @@ def main():
     st.write("Upload an image to generate a 3D model using Stability AI Stable Fast 3D")
 
     # Setup API key first
-    setup_result = APIKeyManager.setup_api_key_ui()
+    setup_result = APIKeyManager.setup_api_key_ui(stop_if_missing=True)
     
     if not setup_result:
         logger.warning("No API key provided, stopping application")
@@ -139,13 +206,8 @@ def main():
     
     logger.info("API key setup successful, proceeding with application")
     
-    # Get the actual API key after setup
-    api_key = APIKeyManager.get_api_key()
-    
-    # Initialize the generator only after we have a valid API key
-    if 'generator' not in st.session_state:
-        logger.info("Creating new StabilityAI3DGenerator instance")
-        st.session_state.generator = StabilityAI3DGenerator(api_key)
+    # Get the generator for the actual API key after setup
+    generator = get_generator(APIKeyManager.get_api_key())
     
     # Create columns for parameters
     col1, col2 = st.columns(2)
@@ -184,14 +246,22 @@ def main():
     
     if uploaded_file is not None:
         try:
-            # Load and display the image
-            image = Image.open(uploaded_file)
+            # Read the upload once and display it without decoding
+            raw_image = uploaded_file.getvalue()
+            st.image(raw_image, caption='Input Image', use_column_width=True)
             
-            st.image(image, caption='Input Image', use_column_width=True)
+            # Opening only parses the header; pixels are decoded on demand
+            image = Image.open(BytesIO(raw_image))
             
             # Process button
-            if st.button('Generate 3D Model'):
-                with st.spinner('Generating 3D model... This may take a minute...'):
+            just_generated = False
+            generate_clicked = st.button('Generate 3D Model')
+            
+            # Fixed slot for progress and errors so the viewer below keeps its
+            # position and its iframe isn't reloaded on reruns
+            status_slot = st.empty()
+            if generate_clicked:
+                with status_slot.container(), st.spinner('Generating 3D model... This may take a minute...'):
                     try:
                         # Prepare parameters
                         params = {
@@ -204,50 +274,69 @@ def main():
                         if vertex_count == -1:
                             params.pop('vertex_count')
                         
-                        # Generate 3D model
-                        model_data = st.session_state.generator.generate_3d_model(image, params)
-                        
-                        # Display 3D viewer
-                        st.subheader("3D Model Viewer")
-                        components.html(
-                            create_model_viewer_html(model_data),
-                            height=450
-                        )
-                        
-                        # Create download buttons
-                        col1, col2 = st.columns(2)
+                        # Downscale to the API's input resolution before encoding
+                        image_bytes = None
+                        if max(image.size) > MAX_INPUT_EDGE:
+                            image.thumbnail((MAX_INPUT_EDGE, MAX_INPUT_EDGE), Image.Resampling.LANCZOS)
+                        elif uploaded_file.type in ('image/png', 'image/jpeg'):
+                            # Uploads the API accepts as-is can be forwarded without re-encoding
+                            image_bytes = raw_image
                         
-                        with col1:
-                            # GLB download
-                            st.download_button(
-                                label="Download GLB Model",
-                                data=model_data,
-                                file_name="generated_model.glb",
-                                mime="model/gltf-binary"
-                            )
-                        
-                        with col2:
-                            # Convert and provide STL download
-                            try:
-                                stl_data = convert_glb_to_stl(model_data)
-                                st.download_button(
-                                    label="Download STL Model",
-                                    data=stl_data,
-                                    file_name="generated_model.stl",
-                                    mime="model/stl"
-                                )
-                            except Exception as e:
-                                st.error(f"Error converting to STL: {str(e)}")
-                        
-                        st.success("3D model generated successfully! Use the viewer above to inspect the model and the buttons to download in your preferred format.")
+                        # Generate 3D model and keep it across reruns
+                        model_data = generator.generate_3d_model(image, params, image_bytes=image_bytes)
+                        st.session_state.model_data = model_data
+                        st.session_state.model_for = uploaded_file.file_id
+                        just_generated = True
                         
                     except Exception as e:
+                        # Don't keep serving a model from an earlier generation
+                        st.session_state.pop('model_data', None)
                         st.error(f"Error generating 3D model: {str(e)}")
-                        logger.error(f"Generation error: {str(e)}")
+                        logger.error("Generation error: %s", e)
+            
+            # Show the latest model for this upload, including on reruns after generation
+            if st.session_state.get('model_for') != uploaded_file.file_id:
+                st.session_state.pop('model_data', None)
+            model_data = st.session_state.get('model_data')
+            if model_data is not None:
+                # Display 3D viewer
+                st.subheader("3D Model Viewer")
+                components.html(
+                    create_model_viewer_html(model_data),
+                    height=450
+                )
+                
+                # Create download buttons
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    # GLB download
+                    st.download_button(
+                        label="Download GLB Model",
+                        data=model_data,
+                        file_name="generated_model.glb",
+                        mime="model/gltf-binary"
+                    )
+                
+                with col2:
+                    # Convert and provide STL download
+                    try:
+                        stl_data = convert_glb_to_stl(model_data)
+                        st.download_button(
+                            label="Download STL Model",
+                            data=stl_data,
+                            file_name="generated_model.stl",
+                            mime="model/stl"
+                        )
+                    except Exception as e:
+                        st.error(f"Error converting to STL: {str(e)}")
+                
+                if just_generated:
+                    st.success("3D model generated successfully! Use the viewer above to inspect the model and the buttons to download in your preferred format.")
         
         except Exception as e:
             st.error(f"Error loading image: {str(e)}")
-            logger.error(f"Image loading error: {str(e)}")
+            logger.error("Image loading error: %s", e)
     
     # Instructions
     with st.expander("How to use"):